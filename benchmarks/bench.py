@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import getopt
+import socket
+import platform
+import threading
+import subprocess
+
+try:
+    from urllib.parse import quote
+    from http.client import HTTPConnection
+except ImportError: # Python 2 backward compatibility
+    from urllib import quote
+    from httplib import HTTPConnection
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'warifuri'))
+
+try:
+    from time import perf_counter as clock
+except ImportError: # Python 2 backward compatibility
+    from time import time as clock
+
+def load_sentences():
+    with open(os.path.join(FIXTURES, 'sentences.txt')) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+def summarize(count, seconds, latencies=None, unit='sentences'):
+    result = {
+        unit: count,
+        'seconds': round(seconds, 6),
+        unit + '_per_sec': round(count / seconds, 2) if seconds > 0 else None,
+    }
+    if latencies:
+        result['p50_ms'] = round(percentile(latencies, 50) * 1000, 4)
+        result['p99_ms'] = round(percentile(latencies, 99) * 1000, 4)
+    return result
+
+def bench_parse(sentences, rounds):
+    from tatomecab import TatoMeCab
+    t = TatoMeCab()
+    t.warm_up()
+    results = {}
+    for name, compact in (('parse', False), ('parse/compact', True)):
+        latencies = []
+        start = clock()
+        for i in range(rounds):
+            for sentence in sentences:
+                before = clock()
+                t.parse(sentence, compact)
+                latencies.append(clock() - before)
+        results[name] = summarize(len(latencies), clock() - start, latencies)
+
+    start = clock()
+    count = 0
+    for tokens in t.iter_parse(sentences * rounds):
+        count = count + 1
+    results['iter_parse'] = summarize(count, clock() - start)
+    return results
+
+def bench_serialize(sentences, rounds):
+    from tatomecab import TatoMeCab
+    from tatomecab.serializers import serializers
+    t = TatoMeCab()
+    parsed = [t.parse(sentence) for sentence in sentences]
+    results = {}
+    for name in sorted(serializers):
+        serializer = serializers[name]
+        latencies = []
+        start = clock()
+        for i in range(rounds):
+            for tokens in parsed:
+                before = clock()
+                serializer.serialize(tokens)
+                latencies.append(clock() - before)
+        results['serialize/' + name] = summarize(len(latencies),
+                                                 clock() - start, latencies)
+    return results
+
+def bench_cli(sentences, rounds, jobs):
+    data = ('\n'.join(sentences) + '\n') * rounds
+    results = {}
+    for j in sorted(set([0] + jobs)):
+        command = [sys.executable, os.path.join(ROOT, 'scripts', 'tatomecab')]
+        if j > 0:
+            command = command + ['-j', str(j)]
+        start = clock()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, env=script_env())
+        process.communicate(data.encode('utf-8'))
+        name = 'cli' if j == 0 else 'cli/j%d' % j
+        results[name] = summarize(len(sentences) * rounds, clock() - start)
+    return results
+
+def script_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    return env
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('webserver did not start on port %d' % port)
+
+def http_client(port, paths, latencies, errors):
+    conn = HTTPConnection('127.0.0.1', port)
+    for path in paths:
+        before = clock()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except Exception as e:
+            errors.append(str(e))
+            conn.close()
+            conn = HTTPConnection('127.0.0.1', port)
+            continue
+        latencies.append(clock() - before)
+    conn.close()
+
+def bench_http(sentences, rounds, concurrency, workers):
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, 'scripts', 'tatomecab-webserver'),
+               '-p', str(port)]
+    if workers > 0:
+        command = command + ['-w', str(workers)]
+    server = subprocess.Popen(command, env=script_env())
+    results = {}
+    try:
+        wait_for_port(port)
+        paths = ['/furigana?str=' + quote(sentence.encode('utf-8'))
+                 for sentence in sentences] * rounds
+        for level in concurrency:
+            latencies = []
+            errors = []
+            threads = [threading.Thread(target=http_client,
+                                        args=(port, paths[i::level], latencies, errors))
+                       for i in range(level)]
+            start = clock()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            result = summarize(len(latencies), clock() - start, latencies,
+                               unit='requests')
+            result['errors'] = len(errors)
+            results['http/c%d' % level] = result
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+def bench_warifuri(rounds):
+    import csv
+    import warifuri
+    w = warifuri.Warifuri()
+    w.load_kanjidic_readings(os.path.join(FIXTURES, 'kanjidic2.xml'))
+    w.load_csv_readings(os.path.join(ROOT, 'warifuri', 'readings.csv'))
+    with open(os.path.join(FIXTURES, 'dict.csv')) as f:
+        rows = list(csv.reader(f))
+    results = {}
+    for name, aligner in (('warifuri/parse_csv_row', 'regex'),
+                          ('warifuri/parse_csv_row/dp', 'dp')):
+        w.aligner = aligner
+        # Cold rounds start from an empty regex cache, as processing a
+        # dictionary sees each surface once. Warm rounds keep it.
+        for suffix, cold in (('', True), ('/warm', False)):
+            w.clear_regex_cache()
+            elapsed = 0
+            for i in range(rounds):
+                if cold:
+                    w.clear_regex_cache()
+                start = clock()
+                for row in rows:
+                    w.parse_csv_row(list(row))
+                elapsed = elapsed + clock() - start
+            results[name + suffix] = summarize(len(rows) * rounds, elapsed,
+                                               unit='rows')
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in sorted(results.items()):
+        try:
+            old = baseline['results'][name]
+        except KeyError:
+            continue
+        for key in result:
+            if key.endswith('_per_sec') and old.get(key) and result[key]:
+                ratio = result[key] / old[key]
+                sys.stderr.write('%-28s %10.2f -> %10.2f %s (%+.1f%%)\n'
+                                 % (name, old[key], result[key], key,
+                                    (ratio - 1) * 100))
+                if ratio < 1 - tolerance:
+                    regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    benchmarks = ['parse', 'serialize', 'cli', 'http', 'warifuri']
+    rounds = 20
+    concurrency = [1, 4, 16]
+    workers = 4
+    output = None
+    baseline = None
+    tolerance = 0.1
+    opts, args = getopt.getopt(sys.argv[1:], 'n:c:w:o:b:t:')
+    for opt, optarg in opts:
+        if opt == '-n':
+            rounds = int(optarg)
+        elif opt == '-c':
+            concurrency = [int(c) for c in optarg.split(',')]
+        elif opt == '-w':
+            workers = int(optarg)
+        elif opt == '-o':
+            output = optarg
+        elif opt == '-b':
+            baseline = optarg
+        elif opt == '-t':
+            tolerance = float(optarg)
+    for name in args:
+        if not name in benchmarks:
+            sys.exit('Unknown benchmark %s, expected some of: %s'
+                     % (name, ', '.join(benchmarks)))
+    if args:
+        benchmarks = args
+
+    sentences = load_sentences()
+    results = {}
+    for name in benchmarks:
+        if name == 'parse':
+            results.update(bench_parse(sentences, rounds))
+        elif name == 'serialize':
+            results.update(bench_serialize(sentences, rounds))
+        elif name == 'cli':
+            results.update(bench_cli(sentences, rounds, [workers]))
+        elif name == 'http':
+            results.update(bench_http(sentences, rounds, concurrency, workers))
+        elif name == 'warifuri':
+            results.update(bench_warifuri(rounds))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rounds': rounds,
+            'sentences': len(sentences),
+        },
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            sys.exit('Regressions: ' + ', '.join(regressions))
@@ -1,18 +1,71 @@
 # coding: utf-8
 
+import io
+import os
+import re
+import hashlib
+from collections import deque
 import MeCab
+from tatomecab.cache import ResultCache, ResultStore, freeze
+from tatomecab.metrics import clock
+from tatomecab.compact import CompactResult
 
 class TatoMeCab():
-    tagger = MeCab.Tagger('')
     kill_readings = u"1234567890１２３４５６７８９０"
+    # Chunks end after sentence-ending punctuation or before a newline,
+    # so that whitespace always starts the next chunk
+    chunk_boundary = re.compile(u'[。！？]|(?=\n)')
+    # The only characters MeCab skips as spacing with ipadic's char.def
+    spaces = u' \t\n\v'
+    non_space = re.compile(u'[^ \t\n\v]')
 
-    def __init__(self):
+    def __init__(self, furigana_table=None, cache=None, store=None,
+                 timings=None, dicdir=None, userdic=None, rcfile=None,
+                 tagger_args=''):
         kata = u"ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペホボポマミムメモャヤュユョヨラリルレロヮワヰヱヲンヴヵヶ"
         kata = kata.replace('ヶ', '')  # for 2ヶ月 etc.
         hira = u"ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすずせぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろゎわゐゑをんゔゕゖ"
         self.kata_to_hira_map = dict((ord(kata[i]), hira[i]) for i in range(len(kata)))
         punct = u"ー・"
         self.chars_without_furi = dict((ord(char), None) for char in kata + hira + punct)
+        self.furigana_table = furigana_table
+        self.cache = cache
+        self.store = store
+        # Histogram of time spent per stage, labelled by stage name
+        self.timings = timings
+        self.stage_times = None
+        args = []
+        if dicdir:
+            args.append('-d ' + self.quote_path(dicdir))
+        if userdic:
+            args.append('-u ' + self.quote_path(userdic))
+        if rcfile:
+            args.append('-r ' + self.quote_path(rcfile))
+        if tagger_args:
+            args.append(tagger_args)
+        self.tagger_args = ' '.join(args)
+        self.tagger = None
+        self.tagger_pid = None
+
+    def quote_path(self, path):
+        # The MeCab bundled with mecab-python3 >= 1.0 understands double
+        # quotes, older libmecab splits on whitespace and keeps them
+        if re.search(u'\\s', path):
+            return '"%s"' % path
+        return path
+
+    def get_tagger(self):
+        # The dictionary is only loaded when first needed. MeCab taggers
+        # are not reentrant, so each instance (and each forked child)
+        # gets its own.
+        pid = os.getpid()
+        if self.tagger is None or self.tagger_pid != pid:
+            self.tagger = MeCab.Tagger(self.tagger_args)
+            self.tagger_pid = pid
+        return self.tagger
+
+    def warm_up(self):
+        self.get_tagger().parse(u'日本語の文を解析する。')
 
     def kata_to_hira(self, kata_str):
         return kata_str.translate(self.kata_to_hira_map)
@@ -24,6 +77,8 @@ class TatoMeCab():
         return True
 
     def split_feature(self, line):
+        if not '"' in line:
+            return line.split(',')
         cols = []
         quote = False
         col = u""
@@ -70,8 +125,58 @@ class TatoMeCab():
                 parsed.append(token)
         return self.strip_unneeded_readings(parsed)
 
-    def parse(self, text):
-        node = self.tagger.parseToNode(text)
+    def get_furi(self, kanjis, feature):
+        if self.stage_times is None:
+            reading = self.kata_to_hira(self.get_reading(feature))
+            return tuple(self.parse_furi(kanjis, reading))
+        start = clock()
+        reading = self.kata_to_hira(self.get_reading(feature))
+        middle = clock()
+        furi = tuple(self.parse_furi(kanjis, reading))
+        self.stage_times[0] = self.stage_times[0] + middle - start
+        self.stage_times[1] = self.stage_times[1] + clock() - middle
+        return furi
+
+    def lookup_furi(self, kanjis, feature, cacheable=True):
+        if self.furigana_table is None:
+            return self.get_furi(kanjis, feature)
+        key = (kanjis, feature)
+        try:
+            return self.furigana_table[key]
+        except KeyError:
+            furi = self.get_furi(kanjis, feature)
+            if cacheable:
+                self.furigana_table[key] = furi
+            return furi
+
+    def split_entry(self, line):
+        # Splits a dictionary CSV line into its surface and the
+        # feature string MeCab reports for it (columns 5 and up)
+        quote = False
+        commas = 0
+        for i, char in enumerate(line):
+            if char == '"':
+                quote = not quote
+            elif char == ',' and not quote:
+                commas = commas + 1
+                if commas == 1:
+                    surface = line[:i]
+                elif commas == 4:
+                    return surface.strip('"'), line[i+1:]
+        raise ValueError('Malformed dictionary entry')
+
+    def load_furigana_table(self, filename, encoding='utf-8'):
+        if self.furigana_table is None:
+            self.furigana_table = {}
+        with io.open(filename, encoding=encoding) as dictfile:
+            for line in dictfile:
+                line = line.rstrip('\r\n')
+                if len(line) == 0:
+                    continue
+                kanjis, feature = self.split_entry(line)
+                self.furigana_table[(kanjis, feature)] = self.get_furi(kanjis, feature)
+
+    def parse_nodes(self, node):
         tokens = []
         while node:
             if node.stat != MeCab.MECAB_BOS_NODE and \
@@ -85,10 +190,188 @@ class TatoMeCab():
                 except AttributeError: # Python 2 backward compatibility
                     kanjis = node.surface
                 try:
-                    reading = self.get_reading(node.feature.decode('utf-8'))
+                    feature = node.feature.decode('utf-8')
                 except AttributeError: # Python 2 backward compatibility
-                    reading = self.get_reading(node.feature)
-                reading = self.kata_to_hira(reading)
-                tokens.append(self.parse_furi(kanjis, reading))
+                    feature = node.feature
+                # Unknown words are not worth remembering
+                cacheable = node.stat != MeCab.MECAB_UNK_NODE
+                tokens.append(list(self.lookup_furi(kanjis, feature, cacheable)))
             node = node.next
         return tokens
+
+    def parse_nodes_compact(self, node, text):
+        result = CompactResult(text)
+        pos = 0
+        while node:
+            if node.stat != MeCab.MECAB_BOS_NODE and \
+               node.stat != MeCab.MECAB_EOS_NODE:
+                space_len = node.rlength - node.length
+                if space_len > 0:
+                    result.add_spaces(space_len)
+                try:
+                    kanjis = node.surface.decode('utf-8')
+                except AttributeError: # Python 2 backward compatibility
+                    kanjis = node.surface
+                try:
+                    feature = node.feature.decode('utf-8')
+                except AttributeError: # Python 2 backward compatibility
+                    feature = node.feature
+                cacheable = node.stat != MeCab.MECAB_UNK_NODE
+                start = text.find(kanjis, pos)
+                result.add_token(start, self.lookup_furi(kanjis, feature, cacheable))
+                pos = start + len(kanjis)
+            node = node.next
+        return result
+
+    def dictionary_fingerprint(self):
+        sha1 = hashlib.sha1()
+        info = self.get_tagger().dictionary_info()
+        while info:
+            try:
+                stat = os.stat(info.filename)
+                mtime, size = stat.st_mtime, stat.st_size
+            except OSError:
+                mtime, size = 0, 0
+            sha1.update(('%s\t%s\t%s\t%s\t%s\n' % (info.filename, info.version,
+                         info.size, mtime, size)).encode('utf-8'))
+            info = info.next
+        return sha1.hexdigest()
+
+    def lookup(self, text):
+        tokens = None
+        if self.cache is not None:
+            tokens = self.cache.get(text)
+        if tokens is None and self.store is not None:
+            tokens = self.store.get(text)
+            if tokens is not None and self.cache is not None:
+                self.cache.put(text, tokens)
+        return tokens
+
+    def remember(self, text, tokens):
+        if self.cache is None and self.store is None:
+            return tokens
+        # Cached results are shared between callers
+        tokens = freeze(tokens)
+        if self.cache is not None:
+            self.cache.put(text, tokens)
+        if self.store is not None:
+            self.store.put(text, tokens)
+        return tokens
+
+    def analyze(self, text, lattice=None, compact=False):
+        if self.timings is not None:
+            start = clock()
+        if lattice is None:
+            node = self.get_tagger().parseToNode(text)
+        else:
+            lattice.set_sentence(text)
+            self.get_tagger().parse(lattice)
+            node = lattice.bos_node()
+        if self.timings is None:
+            if compact:
+                return self.parse_nodes_compact(node, text)
+            return self.parse_nodes(node)
+
+        self.stage_times = [0.0, 0.0]
+        walk_start = clock()
+        if compact:
+            tokens = self.parse_nodes_compact(node, text)
+        else:
+            tokens = self.parse_nodes(node)
+        end = clock()
+        reading, furigana = self.stage_times
+        self.stage_times = None
+        self.timings.observe(walk_start - start, ('mecab',))
+        self.timings.observe(end - walk_start - reading - furigana, ('walk',))
+        self.timings.observe(reading, ('reading',))
+        self.timings.observe(furigana, ('furigana',))
+        return tokens
+
+    def parse(self, text, compact=False):
+        tokens = self.lookup(text)
+        if tokens is None:
+            tokens = self.analyze(text, compact=compact)
+            tokens = self.remember(text, tokens)
+        return tokens
+
+    def iter_parse(self, texts, compact=False):
+        try:
+            lattice = MeCab.Lattice()
+        except AttributeError: # Old bindings without lattice support
+            for text in texts:
+                yield self.parse(text, compact)
+            return
+        for text in texts:
+            tokens = self.lookup(text)
+            if tokens is None:
+                tokens = self.analyze(text, lattice, compact)
+                tokens = self.remember(text, tokens)
+            yield tokens
+
+    def parse_many(self, texts, compact=False):
+        return list(self.iter_parse(texts, compact))
+
+    def find_chunk_end(self, buf, max_chars, pos=0):
+        # Only buf[pos:pos+max_chars+1] is looked at, so that cutting a
+        # long buffer chunk after chunk takes linear time
+        limit = pos + max_chars
+        start = self.non_space.search(buf, pos, limit)
+        if start is None:
+            # Don't let a run of whitespace grow the buffer forever
+            return limit if len(buf) >= limit else None
+        boundary = self.chunk_boundary.search(buf, start.end(), limit + 1)
+        if boundary is not None and boundary.end() <= limit:
+            return boundary.end()
+        if len(buf) <= limit:
+            return None
+        # No boundary close enough, cut before the whitespace preceding
+        # max_chars if any
+        end = limit
+        while end > start.end() and buf[end-1] in self.spaces:
+            end = end - 1
+        return end
+
+    def iter_chunks(self, source, max_chars=4096):
+        if not hasattr(source, 'read'):
+            source = io.StringIO(source)
+        blocks = iter(lambda: source.read(max_chars), type(u'')())
+        buf = u''
+        pos = 0
+        for block in blocks:
+            buf = buf[pos:] + block
+            pos = 0
+            while True:
+                end = self.find_chunk_end(buf, max_chars, pos)
+                if end is None:
+                    break
+                yield buf[pos:end]
+                pos = end
+        if pos < len(buf):
+            yield buf[pos:]
+
+    def iter_tokens(self, source, max_chars=4096):
+        # Whitespace-only chunks give no MeCab node, so their length is
+        # added to the spacing before the next token instead
+        carried = deque()
+        def texts():
+            spaces = 0
+            for chunk in self.iter_chunks(source, max_chars):
+                if self.non_space.search(chunk) is None:
+                    # MeCab counts spacing in bytes
+                    spaces = spaces + len(chunk.encode('utf-8'))
+                    continue
+                carried.append(spaces)
+                spaces = 0
+                yield chunk
+        for tokens in self.iter_parse(texts(), compact=True):
+            spaces = carried.popleft()
+            for token in tokens:
+                if spaces > 0:
+                    kanjis, reading = token[0]
+                    if len(token) == 1 and reading is None and \
+                       kanjis == u' ' * len(kanjis):
+                        token = [(u' ' * (spaces + len(kanjis)), None)]
+                    else:
+                        yield [(u' ' * spaces, None)]
+                    spaces = 0
+                yield token
@@ -0,0 +1,306 @@
+# coding: utf-8
+# Python 3 only, imported by tatomecab-webserver -a
+
+import sys
+import zlib
+import socket
+import asyncio
+import hashlib
+import threading
+from http import HTTPStatus
+from email.utils import formatdate
+from urllib.parse import unquote_plus
+from concurrent.futures import ThreadPoolExecutor
+
+from tatomecab.serializers import negotiate
+from tatomecab.metrics import Gauge, clock
+
+class Overloaded(Exception):
+    pass
+
+class MicroBatcher():
+    # Sentences requested at about the same time are parsed together, and
+    # identical ones only once, by a pool of threads each owning a tagger
+    def __init__(self, parse_batch, executor, max_size=64, max_delay=0.002,
+                 max_queue=1000, batch_sizes=None):
+        self.parse_batch = parse_batch
+        self.executor = executor
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.batch_sizes = batch_sizes
+        # Futures of the sentences waiting or being parsed
+        self.futures = {}
+        self.batch = []
+        self.timer = None
+
+    def __len__(self):
+        return len(self.futures)
+
+    async def parse(self, text):
+        try:
+            future = self.futures[text]
+        except KeyError:
+            if len(self.futures) >= self.max_queue:
+                raise Overloaded()
+            future = asyncio.get_running_loop().create_future()
+            self.futures[text] = future
+            self.batch.append(text)
+            if len(self.batch) >= self.max_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(
+                    self.max_delay, self.flush)
+        # Another request may be waiting for the same result
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.batch = self.batch, []
+        if self.batch_sizes is not None:
+            self.batch_sizes.observe(len(batch))
+        done = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.parse_batch, batch)
+        done.add_done_callback(lambda done: self.complete(batch, done))
+
+    def complete(self, batch, done):
+        error = done.exception()
+        results = done.result() if error is None else [None] * len(batch)
+        for text, result in zip(batch, results):
+            future = self.futures.pop(text)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+class AsyncTatoMecabServer():
+    # Same interface as TatoMecabServer, so that prefork() can run it
+    gzip_min_size = None
+    fingerprint = None
+    metrics = None
+    slow_request = None
+    max_input = None
+    max_batch = 64
+    batch_delay = 0.002
+    max_queue = 1000
+    # Idle keep-alive connections are closed after that many seconds
+    timeout = 15
+
+    def __init__(self, address, factory, workers=0, backlog=None):
+        self.factory = factory
+        self.local = threading.local()
+        self.workers = max(workers, 1)
+        self.handled = 0
+        self.batcher = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.listen(backlog or 128)
+
+    def get_tatomecab(self):
+        try:
+            return self.local.tatomecab
+        except AttributeError:
+            self.local.tatomecab = self.factory()
+            return self.local.tatomecab
+
+    def get_fingerprint(self):
+        if self.fingerprint is None:
+            self.fingerprint = self.get_tatomecab().dictionary_fingerprint()
+        return self.fingerprint
+
+    def warm_up(self, barrier):
+        # Makes sure every thread of the pool gets its own tagger
+        self.get_tatomecab().warm_up()
+        barrier.wait()
+
+    def parse_batch(self, texts):
+        return list(self.get_tatomecab().iter_parse(texts, compact=True))
+
+    def serve(self, max_requests=0):
+        asyncio.run(self.run(max_requests))
+
+    async def run(self, max_requests):
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(self.workers)
+        barrier = threading.Barrier(self.workers)
+        await asyncio.gather(*[loop.run_in_executor(executor, self.warm_up, barrier)
+                               for i in range(self.workers)])
+        await loop.run_in_executor(executor, self.get_fingerprint)
+        batch_sizes = None
+        if self.metrics is not None:
+            batch_sizes = self.metrics.batch_sizes
+            self.metrics.registry.add(Gauge('tatomecab_queue_sentences',
+                'Sentences waiting to be parsed.', func=lambda: len(self.batcher)))
+        self.batcher = MicroBatcher(self.parse_batch, executor, self.max_batch,
+                                    self.batch_delay, self.max_queue, batch_sizes)
+        self.max_requests = max_requests
+        self.connections = set()
+        self.done = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection,
+                                            sock=self.socket)
+        async with server:
+            await self.done.wait()
+            server.close()
+            if self.connections:
+                await asyncio.wait(self.connections)
+        executor.shutdown()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader),
+                                                     self.timeout)
+                except (asyncio.TimeoutError, ConnectionError):
+                    break
+                except ValueError:
+                    self.send(writer, 400, 'Bad request.', keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, version, headers = request
+                keep_alive = self.keeps_alive(version, headers)
+                self.handled = self.handled + 1
+                if self.max_requests > 0 and self.handled >= self.max_requests:
+                    keep_alive = False
+                    self.done.set()
+                await self.handle_request(writer, method, path, headers,
+                                          keep_alive)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.connections.discard(task)
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, path, version = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        return method, path, version, headers
+
+    def keeps_alive(self, version, headers):
+        connection = headers.get('connection', '').lower()
+        # Request bodies are not supported, they would be left unread
+        if 'content-length' in headers or 'transfer-encoding' in headers:
+            return False
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def parse_query(self, path):
+        d_args = {}
+        method = path
+        try:
+            method, args = path.split('?', 1)
+            for arg in args.split('&'):
+                try:
+                    var, val = arg.split('=', 1)
+                except ValueError:
+                    continue
+                d_args[var] = unquote_plus(val)
+        except ValueError:
+            pass
+        return method, d_args
+
+    def send(self, writer, code, body, headers=(), keep_alive=True):
+        if not isinstance(body, bytes):
+            headers = list(headers) + [('Content-type', 'text/plain; charset=utf-8')]
+            body = body.encode('utf-8')
+        lines = ['HTTP/1.1 %d %s' % (code, HTTPStatus(code).phrase),
+                 'Server: tatomecab',
+                 'Date: %s' % formatdate(usegmt=True)]
+        lines.extend('%s: %s' % header for header in headers)
+        if code != 304:
+            lines.append('Content-Length: %d' % len(body))
+        # HTTP/1.0 clients asking for keep-alive wait for the header
+        lines.append('Connection: %s' % ('keep-alive' if keep_alive else 'close'))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        writer.write(head + body)
+        return code
+
+    async def handle_request(self, writer, method, path, headers, keep_alive):
+        endpoint, args = self.parse_query(path)
+        if method != 'GET':
+            self.send(writer, 405, 'Only GET is supported.', [('Allow', 'GET')],
+                      keep_alive)
+        elif endpoint == '/furigana':
+            await self.track(method, endpoint, self.send_furigana,
+                             writer, args, headers, keep_alive)
+        elif endpoint == '/metrics':
+            registry = self.metrics.registry
+            self.send(writer, 200, registry.render().encode('utf-8'),
+                      [('Content-type', registry.content_type)], keep_alive)
+        else:
+            self.send(writer, 404, 'Service not found', (), keep_alive)
+
+    async def track(self, method, endpoint, handler, *args):
+        metrics = self.metrics
+        metrics.in_flight.inc()
+        start = clock()
+        code = 500
+        try:
+            code = await handler(*args)
+        finally:
+            elapsed = clock() - start
+            metrics.in_flight.dec()
+            metrics.requests.inc((method, endpoint, str(code)))
+            metrics.latency.observe(elapsed, (endpoint,))
+            if self.slow_request is not None and elapsed >= self.slow_request:
+                sys.stderr.write('slow request (%.3fs): %s\n'
+                                 % (elapsed, repr(args[1].get('str'))[:1000]))
+
+    def get_etag(self, serializer, text):
+        data = u'\0'.join((self.fingerprint, serializer.content_type, text))
+        return 'W/"%s"' % hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    async def send_furigana(self, writer, args, headers, keep_alive):
+        if not 'str' in args:
+            return self.send(writer, 400, "Parameter 'str' is mandatory.",
+                             (), keep_alive)
+        text = args['str']
+        if self.max_input is not None and len(text) > self.max_input:
+            return self.send(writer, 413, 'At most %d characters.'
+                             % self.max_input, (), keep_alive)
+        self.metrics.input_length.observe(len(text))
+        serializer = negotiate(args.get('format'), headers.get('accept'))
+        etag = self.get_etag(serializer, text)
+        if etag in headers.get('if-none-match', ''):
+            return self.send(writer, 304, b'', [('ETag', etag)], keep_alive)
+        try:
+            parsed = await self.batcher.parse(text)
+        except Overloaded:
+            # Failing fast keeps the latency of accepted requests flat
+            return self.send(writer, 503, 'Too many pending requests.',
+                             [('Retry-After', '1')], keep_alive)
+        start = clock()
+        body = serializer.serialize(parsed)
+        response_headers = [('Content-type', serializer.content_type),
+                            ('ETag', etag),
+                            ('Vary', 'Accept, Accept-Encoding')]
+        if self.gzip_min_size is not None and len(body) >= self.gzip_min_size \
+           and 'gzip' in headers.get('accept-encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            response_headers.append(('Content-Encoding', 'gzip'))
+        self.metrics.stages.observe(clock() - start, ('serialize',))
+        return self.send(writer, 200, body, response_headers, keep_alive)
@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+def freeze(tokens):
+    return tuple(tuple(subtokens) for subtokens in tokens)
+
+def entry_size(text, tokens):
+    size = sys.getsizeof(text) + sys.getsizeof(tokens)
+    for subtokens in tokens:
+        size = size + sys.getsizeof(subtokens)
+        for kanjis, reading in subtokens:
+            size = size + sys.getsizeof(kanjis) + sys.getsizeof(reading)
+    return size
+
+class ResultCache():
+    def __init__(self, max_entries=10000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, text):
+        with self.lock:
+            try:
+                entry = self.entries.pop(text)
+            except KeyError:
+                self.misses = self.misses + 1
+                return None
+            self.entries[text] = entry
+            self.hits = self.hits + 1
+            return entry[0]
+
+    def put(self, text, tokens):
+        size = entry_size(text, tokens)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            try:
+                self.size = self.size - self.entries.pop(text)[1]
+            except KeyError:
+                pass
+            self.entries[text] = (tokens, size)
+            self.size = self.size + size
+            while len(self.entries) > self.max_entries or \
+                  (self.max_bytes is not None and self.size > self.max_bytes):
+                evicted = self.entries.popitem(last=False)[1]
+                self.size = self.size - evicted[1]
+                self.evictions = self.evictions + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+class ResultStore():
+    def __init__(self, filename, fingerprint, commit_every=100, deferred=False,
+                 flush_interval=None):
+        self.fingerprint = fingerprint
+        self.commit_every = commit_every
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        # A deferred store only reads, new results are kept for
+        # take_deferred() so that a single process writes to the file
+        self.deferred = [] if deferred else None
+        self.flusher = None
+        if flush_interval is not None:
+            # ...or they are written by a background thread, in a single
+            # transaction every flush_interval seconds
+            self.closing = threading.Event()
+            self.flusher = threading.Thread(target=self.flush_every,
+                                            args=(flush_interval,))
+            self.flusher.daemon = True
+            self.flusher.start()
+        if deferred:
+            return
+        # Readers and the writer of other processes don't block each other
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'hash TEXT PRIMARY KEY, dictionary TEXT, tokens TEXT)')
+        # Results from another dictionary are stale
+        self.db.execute('DELETE FROM results WHERE dictionary != ?',
+                        (fingerprint,))
+        self.db.commit()
+
+    def key(self, text):
+        data = self.fingerprint + u'\0' + text
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        with self.lock:
+            row = self.db.execute('SELECT tokens FROM results WHERE hash = ?',
+                                  (self.key(text),)).fetchone()
+        if row is None:
+            return None
+        return freeze(json.loads(row[0]))
+
+    def row(self, text, tokens):
+        data = json.dumps(tokens, ensure_ascii=False, separators=(',', ':'))
+        return (self.key(text), self.fingerprint, data)
+
+    def put(self, text, tokens):
+        if self.deferred is not None:
+            with self.lock:
+                self.deferred.append((text, tokens))
+            return
+        row = self.row(text, tokens)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                            row)
+            self.pending = self.pending + 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def take_deferred(self):
+        with self.lock:
+            deferred, self.deferred = self.deferred, []
+        return deferred
+
+    def flush_every(self, interval):
+        while not self.closing.wait(interval):
+            self.flush()
+
+    def flush(self):
+        rows = [self.row(text, tokens) for text, tokens in self.take_deferred()]
+        if len(rows) == 0:
+            return
+        with self.lock:
+            try:
+                self.db.executemany('INSERT OR REPLACE INTO results '
+                                    'VALUES (?, ?, ?)', rows)
+                self.db.commit()
+            except sqlite3.OperationalError:
+                # Still locked by another process after the timeout, the
+                # results are only lost from the store
+                self.db.rollback()
+
+    def close(self):
+        if self.flusher is not None:
+            self.closing.set()
+            self.flusher.join()
+            self.flush()
+        with self.lock:
+            self.db.commit()
+            self.db.close()
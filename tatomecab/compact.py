@@ -0,0 +1,67 @@
+# coding: utf-8
+
+from array import array
+
+try:
+    from sys import intern
+except ImportError: # Python 2 backward compatibility
+    pass
+
+class CompactResult(object):
+    # Subtokens are stored as offsets into the parsed text rather than
+    # as separate strings. Whitespace subtokens have a start offset of
+    # -1 and store the number of spaces as their end offset.
+    __slots__ = ('text', 'starts', 'ends', 'readings', 'token_ends')
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = array('l')
+        self.ends = array('l')
+        self.readings = []
+        self.token_ends = array('l')
+
+    def add_spaces(self, count):
+        self.starts.append(-1)
+        self.ends.append(count)
+        self.readings.append(None)
+        self.token_ends.append(len(self.readings))
+
+    def add_token(self, start, subtokens):
+        for kanjis, reading in subtokens:
+            end = start + len(kanjis)
+            self.starts.append(start)
+            self.ends.append(end)
+            if reading is not None:
+                reading = intern(reading)
+            self.readings.append(reading)
+            start = end
+        self.token_ends.append(len(self.readings))
+
+    def subtoken(self, i):
+        start = self.starts[i]
+        if start < 0:
+            return (u' ' * self.ends[i], None)
+        return (self.text[start:self.ends[i]], self.readings[i])
+
+    def token(self, index):
+        first = self.token_ends[index-1] if index > 0 else 0
+        return [self.subtoken(i) for i in range(first, self.token_ends[index])]
+
+    def __len__(self):
+        return len(self.token_ends)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + len(self.token_ends)
+        if index < 0 or index >= len(self.token_ends):
+            raise IndexError('token index out of range')
+        return self.token(index)
+
+    def __iter__(self):
+        first = 0
+        for last in self.token_ends:
+            yield [self.subtoken(i) for i in range(first, last)]
+            first = last
+
+    def tolist(self):
+        return list(self)
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import threading
+
+try:
+    from time import perf_counter as clock
+except ImportError: # Python 2 backward compatibility
+    from time import time as clock
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (name, value) for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+def label_key(sample):
+    # Label values of different types must not break rendering
+    return tuple(str(value) for value in sample[0])
+
+class Counter():
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.func = func
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        if self.func is not None:
+            return [((), self.func())]
+        with self.lock:
+            return sorted(self.values.items(), key=label_key)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for labels, value in self.samples():
+            lines.append('%s%s %s' % (self.name,
+                         format_labels(self.labels, labels), value))
+        return lines
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, labels=(), value=1):
+        self.inc(labels, -value)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram():
+    type = 'histogram'
+    default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            try:
+                counts, total = self.series[labels]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            counts[i] = counts[i] + 1
+            self.series[labels] = (counts, total + value)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        with self.lock:
+            series = sorted(((labels, (list(counts), total))
+                             for labels, (counts, total) in self.series.items()),
+                            key=label_key)
+        names = self.labels + ('le',)
+        for labels, (counts, total) in series:
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated = cumulated + count
+                lines.append('%s_bucket%s %d' % (self.name,
+                             format_labels(names, labels + (bound,)), cumulated))
+            label_str = format_labels(self.labels, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_str, total))
+            lines.append('%s_count%s %d' % (self.name, label_str, cumulated))
+        return lines
+
+class Registry():
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+import json
+
+def as_list(tokens):
+    # Compact results are turned into lists only where needed
+    if isinstance(tokens, (list, tuple)):
+        return tokens
+    return tokens.tolist()
+
+class XmlSerializer():
+    content_type = 'text/xml'
+    header = u'<?xml version="1.0" encoding="UTF-8"?>\n<root>\n'
+    footer = u'</root>\n'
+    separator = u''
+
+    def write_parse(self, parts, tokens):
+        write = parts.append
+        extend = parts.extend
+        write(u'<parse>\n')
+        for subtokens in tokens:
+            write(u'<token>')
+            for kanjis, reading in subtokens:
+                if reading is None:
+                    extend((u'<![CDATA[', kanjis, u']]>'))
+                else:
+                    extend((u'<reading furigana="', reading, u'"><![CDATA[',
+                            kanjis, u']]></reading>'))
+            write(u'</token>\n')
+        write(u'</parse>\n')
+
+    def parse(self, tokens):
+        parts = []
+        self.write_parse(parts, tokens)
+        return u''.join(parts)
+
+    def serialize(self, tokens):
+        parts = [self.header]
+        self.write_parse(parts, tokens)
+        parts.append(self.footer)
+        return u''.join(parts).encode('utf-8')
+
+class JsonSerializer():
+    content_type = 'application/json'
+    header = u'['
+    footer = u']\n'
+    separator = u','
+
+    def parse(self, tokens):
+        return json.dumps(as_list(tokens), ensure_ascii=False,
+                          separators=(',', ':'))
+
+    def serialize(self, tokens):
+        return self.parse(tokens).encode('utf-8')
+
+class NdjsonSerializer(JsonSerializer):
+    content_type = 'application/x-ndjson'
+    header = u''
+    footer = u''
+    separator = u''
+
+    def parse(self, tokens):
+        return JsonSerializer.parse(self, tokens) + u'\n'
+
+serializers = {
+    'xml': XmlSerializer(),
+    'json': JsonSerializer(),
+    'ndjson': NdjsonSerializer(),
+}
+
+def negotiate(format=None, accept=None, default='xml'):
+    if format in serializers:
+        return serializers[format]
+    if accept:
+        for name in ('ndjson', 'json', 'xml'):
+            if serializers[name].content_type in accept:
+                return serializers[name]
+    return serializers[default]
+
+def escape_html(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+class PlainWriter():
+    def write_sentence(self, parts, sentence_id, tokens):
+        extend = parts.extend
+        for subtokens in tokens:
+            for kanjis, reading in subtokens:
+                extend((kanjis, '\t', str(reading), '\n'))
+
+class TsvWriter():
+    def write_sentence(self, parts, sentence_id, tokens):
+        extend = parts.extend
+        sentence_id = str(sentence_id)
+        for i, subtokens in enumerate(tokens):
+            token_id = str(i)
+            for kanjis, reading in subtokens:
+                extend((sentence_id, '\t', token_id, '\t', kanjis, '\t',
+                        reading or '', '\n'))
+
+class JsonlWriter():
+    def write_sentence(self, parts, sentence_id, tokens):
+        parts.extend(('{"id":', str(sentence_id), ',"tokens":',
+                      json.dumps(as_list(tokens), ensure_ascii=False,
+                                 separators=(',', ':')),
+                      '}\n'))
+
+class RubyWriter():
+    def write_sentence(self, parts, sentence_id, tokens):
+        extend = parts.extend
+        for subtokens in tokens:
+            for kanjis, reading in subtokens:
+                if not reading:
+                    parts.append(escape_html(kanjis))
+                else:
+                    extend(('<ruby>', escape_html(kanjis), '<rt>',
+                            escape_html(reading), '</rt></ruby>'))
+        parts.append('\n')
+
+writers = {
+    'plain': PlainWriter(),
+    'tsv': TsvWriter(),
+    'jsonl': JsonlWriter(),
+    'ruby': RubyWriter(),
+}
+
+class StreamWriter():
+    def __init__(self, output, writer, buffer_size=1000):
+        self.output = output
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.pending = 0
+
+    def write(self, sentence_id, tokens):
+        self.writer.write_sentence(self.parts, sentence_id, tokens)
+        self.pending = self.pending + 1
+        if self.pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.output.write(''.join(self.parts))
+        # The same list is reused for the next sentences
+        del self.parts[:]
+        self.pending = 0
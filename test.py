@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# coding: utf-8
+
+import io
+import unittest
+from tatomecab import TatoMeCab, ResultCache
+from tatomecab.cache import freeze, entry_size
+from tatomecab.compact import CompactResult
+from tatomecab.serializers import serializers
+
+class ChunkTest(unittest.TestCase):
+    def setUp(self):
+        # The tagger is only loaded when parsing
+        self.tatomecab = TatoMeCab()
+
+    def chunks(self, source, max_chars):
+        return list(self.tatomecab.iter_chunks(source, max_chars))
+
+    def test_sentence_boundary(self):
+        self.assertEqual(2, self.tatomecab.find_chunk_end(u'猫。犬', 10))
+        self.assertEqual([u'猫。', u'犬！', u'鳥'],
+                         self.chunks(u'猫。犬！鳥', 10))
+
+    def test_newline_starts_next_chunk(self):
+        self.assertEqual([u'猫', u'\n犬', u'\n'],
+                         self.chunks(u'猫\n犬\n', 10))
+
+    def test_leading_whitespace_kept_with_sentence(self):
+        self.assertEqual(4, self.tatomecab.find_chunk_end(u'  猫。犬', 10))
+        self.assertEqual(None, self.tatomecab.find_chunk_end(u'  猫', 10))
+
+    def test_whitespace_only(self):
+        self.assertEqual(None, self.tatomecab.find_chunk_end(u'   ', 10))
+        self.assertEqual(4, self.tatomecab.find_chunk_end(u'    ', 4))
+
+    def test_whitespace_buffer_is_bounded(self):
+        text = u' ' * 100 + u'猫。'
+        chunks = self.chunks(io.StringIO(text), 8)
+        self.assertEqual(text, u''.join(chunks))
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+
+    def test_max_chars_without_boundary(self):
+        self.assertEqual(4, self.tatomecab.find_chunk_end(u'猫犬鳥魚牛', 4))
+        self.assertEqual(None, self.tatomecab.find_chunk_end(u'猫犬鳥魚', 4))
+        self.assertEqual([u'猫犬鳥魚', u'牛'], self.chunks(u'猫犬鳥魚牛', 4))
+
+    def test_max_chars_cuts_before_whitespace(self):
+        self.assertEqual(2, self.tatomecab.find_chunk_end(u'猫犬  鳥魚', 4))
+
+    def test_boundary_past_max_chars(self):
+        self.assertEqual(4, self.tatomecab.find_chunk_end(u'猫犬鳥魚牛。', 4))
+
+    def test_start_position(self):
+        self.assertEqual(4, self.tatomecab.find_chunk_end(u'猫。犬。鳥。', 4, 2))
+        self.assertEqual(6, self.tatomecab.find_chunk_end(u'猫。犬犬犬犬犬', 4, 2))
+        self.assertEqual(None, self.tatomecab.find_chunk_end(u'猫。  ', 4, 2))
+
+    def test_string_and_file_give_same_chunks(self):
+        text = u'猫が好き。 犬も。\n' * 50 + u'鳥' * 30 + u' ' * 30 + u'魚'
+        self.assertEqual(self.chunks(io.StringIO(text), 16),
+                         self.chunks(text, 16))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(max_entries=2)
+        self.cat = freeze([[(u'猫', u'ねこ')]])
+        self.dog = freeze([[(u'犬', u'いぬ')]])
+        self.bird = freeze([[(u'鳥', u'とり')]])
+
+    def test_get(self):
+        self.cache.put(u'猫', self.cat)
+        self.assertEqual(self.cat, self.cache.get(u'猫'))
+        self.assertEqual(None, self.cache.get(u'犬'))
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put(u'猫', self.cat)
+        self.cache.put(u'犬', self.dog)
+        self.cache.get(u'猫')
+        self.cache.put(u'鳥', self.bird)
+        self.assertEqual(None, self.cache.get(u'犬'))
+        self.assertEqual(self.cat, self.cache.get(u'猫'))
+        self.assertEqual(self.bird, self.cache.get(u'鳥'))
+
+    def test_put_again_replaces(self):
+        self.cache.put(u'猫', self.dog)
+        self.cache.put(u'猫', self.cat)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(entry_size(u'猫', self.cat), self.cache.stats()['bytes'])
+        self.assertEqual(self.cat, self.cache.get(u'猫'))
+
+    def test_max_bytes(self):
+        size = entry_size(u'猫', self.cat)
+        cache = ResultCache(max_entries=10, max_bytes=2 * size)
+        cache.put(u'猫', self.cat)
+        cache.put(u'犬', self.dog)
+        cache.put(u'鳥', self.bird)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get(u'猫'))
+        self.assertTrue(cache.stats()['bytes'] <= 2 * size)
+
+    def test_entry_larger_than_max_bytes(self):
+        cache = ResultCache(max_bytes=entry_size(u'猫', self.cat) - 1)
+        cache.put(u'猫', self.cat)
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.stats()['evictions'])
+
+    def test_stats(self):
+        self.cache.put(u'猫', self.cat)
+        self.cache.put(u'犬', self.dog)
+        self.cache.put(u'鳥', self.bird)
+        self.cache.get(u'鳥')
+        self.cache.get(u'猫')
+        stats = self.cache.stats()
+        self.assertEqual(2, stats['entries'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(entry_size(u'犬', self.dog) + entry_size(u'鳥', self.bird),
+                         stats['bytes'])
+
+    def test_clear(self):
+        self.cache.put(u'猫', self.cat)
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.stats()['bytes'])
+        self.assertEqual(None, self.cache.get(u'猫'))
+
+def sample_result():
+    # As parsed from u'猫  が好き', where MeCab reports the spaces
+    # with the token following them
+    result = CompactResult(u'猫  が好き')
+    result.add_token(0, [(u'猫', u'ねこ')])
+    result.add_spaces(2)
+    result.add_token(3, [(u'が', None)])
+    result.add_token(4, [(u'好', u'す'), (u'き', None)])
+    tokens = [
+        [(u'猫', u'ねこ')],
+        [(u'  ', None)],
+        [(u'が', None)],
+        [(u'好', u'す'), (u'き', None)],
+    ]
+    return result, tokens
+
+class CompactResultTest(unittest.TestCase):
+    def setUp(self):
+        self.result, self.tokens = sample_result()
+
+    def test_tolist(self):
+        self.assertEqual(self.tokens, self.result.tolist())
+        self.assertEqual(self.tokens, list(self.result))
+
+    def test_len(self):
+        self.assertEqual(4, len(self.result))
+        self.assertEqual(0, len(CompactResult(u'')))
+
+    def test_index(self):
+        for i in range(len(self.tokens)):
+            self.assertEqual(self.tokens[i], self.result[i])
+        for i in range(1, len(self.tokens) + 1):
+            self.assertEqual(self.tokens[-i], self.result[-i])
+
+    def test_index_out_of_range(self):
+        self.assertRaises(IndexError, lambda: self.result[4])
+        self.assertRaises(IndexError, lambda: self.result[-5])
+
+    def test_spaces(self):
+        self.assertEqual([(u'  ', None)], self.result[1])
+
+    def test_freeze(self):
+        self.assertEqual(freeze(self.tokens), freeze(self.result))
+
+def xmlize(tokens):
+    # The webserver's output before serializers were added
+    res = '<?xml version="1.0" encoding="UTF-8"?>\n<root>\n<parse>\n'
+    for subtokens in tokens:
+        res = res + '<token>'
+        for kanjis, reading in subtokens:
+            if reading is None:
+                res = res + '<![CDATA[' + kanjis + ']]>'
+            else:
+                res = res + '<reading furigana="%s"><![CDATA[%s]]></reading>' % (reading, kanjis)
+        res = res + '</token>\n'
+    res = res + '</parse>\n</root>\n'
+    return res
+
+class SerializerTest(unittest.TestCase):
+    def setUp(self):
+        self.result, self.tokens = sample_result()
+
+    def test_xml_unchanged(self):
+        xml = serializers['xml']
+        expected = xmlize(self.tokens).encode('utf-8')
+        self.assertEqual(expected, xml.serialize(self.tokens))
+        self.assertEqual(expected, xml.serialize(freeze(self.tokens)))
+        self.assertEqual(expected, xml.serialize(self.result))
+
+    def test_json(self):
+        json = serializers['json']
+        self.assertEqual(json.serialize(self.tokens), json.serialize(self.result))
+        self.assertEqual(u'[[["猫","ねこ"]],[["  ",null]],[["が",null]],'
+                         u'[["好","す"],["き",null]]]'.encode('utf-8'),
+                         json.serialize(self.result))
+
+def tagger_available():
+    try:
+        TatoMeCab().warm_up()
+    except RuntimeError:
+        return False
+    return True
+
+@unittest.skipUnless(tagger_available(), 'MeCab has no usable dictionary')
+class TokenTest(unittest.TestCase):
+    def setUp(self):
+        self.tatomecab = TatoMeCab()
+
+    def assert_same_tokens(self, text, max_chars):
+        self.assertEqual(self.tatomecab.parse(text, compact=True).tolist(),
+                         list(self.tatomecab.iter_tokens(text, max_chars)))
+
+    def test_sentences(self):
+        self.assert_same_tokens(u'猫が好きです。 犬も好きです！\n鳥は？', 8)
+
+    def test_long_whitespace(self):
+        self.assert_same_tokens(u'犬。' + u' ' * 20 + u'猫', 8)
+        self.assert_same_tokens(u'犬。' + u'\t \n' * 10 + u'猫。', 8)
+        self.assert_same_tokens(u' ' * 30 + u'猫。', 8)
+
+    def test_full_width_spaces_are_tokens(self):
+        self.assert_same_tokens(u'犬。' + u'\u3000' * 10 + u'猫', 8)
+
+    def test_trailing_whitespace(self):
+        self.assert_same_tokens(u'犬。' + u' ' * 20, 8)
+
+if __name__ == '__main__':
+    unittest.main()
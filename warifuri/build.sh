@@ -10,9 +10,6 @@ maybe_download() {
 }
 
 maybe_download kanjidic2.xml.gz https://www.edrdg.org/kanjidic/kanjidic2.xml.gz
-if [ ! -e kanjidic2.xml ]; then
-    gunzip -k kanjidic2.xml.gz
-fi
 
 DICT_BASE_NAME=mecab-naist-jdic-0.6.3b-20111013
 maybe_download "$DICT_BASE_NAME.tar.gz" "http://deb.debian.org/debian/pool/main/m/mecab-naist-jdic/mecab-naist-jdic_0.6.3.b-20111013.orig.tar.gz"
@@ -20,8 +17,8 @@ if [ ! -d "$DICT_BASE_NAME" ]; then
     tar xf "$DICT_BASE_NAME.tar.gz"
 fi
 
-for csv in $DICT_BASE_NAME/*.csv; do
-    echo "Processing $csv..."
-    PYTHONIOENCODING=EUC-JP nice -n 19 ./warifuri.py ./kanjidic2.xml ./readings.csv < "$csv" > "$csv".new \
-        && mv "$csv".new "$csv"
-done
+# Readings are loaded once, and rows of all the files share the workers.
+# Running it again after editing readings.csv only processes the rows
+# using the edited readings.
+nice -n 19 ./warifuri.py -s ./readings.snapshot -m ./manifest.sqlite -e EUC-JP -o "$DICT_BASE_NAME" \
+    ./kanjidic2.xml.gz ./readings.csv $DICT_BASE_NAME/*.csv
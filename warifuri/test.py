@@ -1,6 +1,9 @@
 #!/usr/bin/python
 
+import os
+import signal
 import warifuri
+import tempfile
 import unittest
 
 class WarifuriTest(unittest.TestCase):
@@ -169,8 +172,70 @@ class WarifuriTest(unittest.TestCase):
     def test_jukujikun_with_okurigana(self):
         self.assert_split_furi(['衣','被','ぎ'], ['きぬ','かつ','ぎ'])
 
+    def test_ambiguous_split_follows_reading_order(self):
+        self.warifuri.add_readings('甲', ['あ', 'あい'])
+        self.warifuri.add_readings('乙', ['いう', 'う'])
+        self.assert_split_furi(['甲','乙'], ['あ','いう'])
+
+    def test_regex_cache_follows_readings(self):
+        self.assert_split_furi(['間','接'], ['かん','せつ'])
+        self.assert_split_furi(['間','接'], ['けん','せつ'])
+        self.assertEqual(1, self.warifuri.regex_cache_misses)
+        self.assertEqual(1, self.warifuri.regex_cache_hits)
+        self.warifuri.add_readings('接', ['ぜつ'])
+        self.assert_split_furi(['間','接'], ['かん','ぜつ'])
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'readings.snapshot')
+            self.warifuri.save_snapshot(filename, ['a'])
+            self.warifuri = warifuri.Warifuri()
+            self.assertFalse(self.warifuri.load_snapshot(filename, ['b']))
+            self.assertTrue(self.warifuri.load_snapshot(filename, ['a']))
+        self.assert_split_furi(['一人', '暮', 'らし'], ['ひとり', 'ぐ', 'らし'])
+
+    def test_manifest_changed_readings(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'manifest')
+            manifest = warifuri.Manifest(filename, self.warifuri)
+            self.assertTrue(manifest.is_affected('学校'))
+            manifest.close()
+            self.warifuri.add_readings('校', ['こう'])
+            self.warifuri.add_readings('学生', ['がく|せい'])
+            manifest = warifuri.Manifest(filename, self.warifuri)
+            manifest.close()
+        self.assertTrue(manifest.is_affected('学校'))
+        self.assertTrue(manifest.is_affected('大学生'))
+        self.assertFalse(manifest.is_affected('学'))
+        self.assertFalse(manifest.is_affected('生'))
+
+    def test_timeout(self):
+        self.warifuri.add_readings('甲', ['あ', 'ああ'])
+        self.warifuri.aligner = 'regex'
+        self.warifuri.test_readings = True
+        self.warifuri.profile = True
+        self.warifuri.timeout = 0.05
+        handler = signal.signal(signal.SIGALRM, warifuri.raise_timeout)
+        try:
+            row = ['甲' * 40] + [''] * 10 + ['あ' * 55 + 'い']
+            self.assertIsNone(self.warifuri.parse_csv_row(row))
+            self.assertEqual('timeout', self.warifuri.row_profile['failure'])
+        finally:
+            signal.signal(signal.SIGALRM, handler)
+
     def test_small_ke(self):
         self.assert_split_furi(['ヶ', '月'], ['か','げつ'])
 
+class PathAlignerTest(WarifuriTest):
+    def setUp(self):
+        super().setUp()
+        self.warifuri.aligner = 'dp'
+
+    def test_many_ambiguous_readings(self):
+        self.warifuri.add_readings('甲', ['あ', 'ああ'])
+        self.warifuri.test_readings = True
+        self.assertRaises(ValueError, self.warifuri.split_furi,
+                          '甲' * 30, 'あ' * 40 + 'い')
+
 if __name__ == '__main__':
     unittest.main()
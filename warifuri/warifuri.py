@@ -1,11 +1,190 @@
 #!/usr/bin/python3
 
 import xml.etree.ElementTree as ET
-import sys, string, re, csv
-from multiprocessing.dummy import Pool, Queue, Lock
+import sys, os, string, re, csv, gzip, time, json, heapq, pickle, signal, sqlite3, hashlib
+from collections import deque, OrderedDict
+from multiprocessing import Pool, cpu_count
+
+class SplitTimeout(ValueError):
+    pass
+
+def raise_timeout(signum, frame):
+    raise SplitTimeout('Timed out splitting furigana')
+
+def path_kind(path):
+    # Kind of the group made from a [is_kanji, segment, readings] path
+    if path[0]:
+        return 'kanji'
+    elif path[1]:
+        return 'kana'
+    elif path[2] in (['.+'], ['']):
+        return 'optimistic'
+    else:
+        return 'jukujikun'
+
+class Alignment():
+    def __init__(self, groups, kinds):
+        self.matched = groups
+        self.kinds = kinds
+
+    def groups(self):
+        return self.matched
+
+class PathAligner():
+    # Matches furigana against the paths of Warifuri.build_paths like the
+    # regex made by Warifuri.to_regex does, alternatives being tried in the
+    # same order, but failures are memoized by (state, position) so that
+    # long compounds with many readings can't backtrack exponentially
+    END, CAPTURE, ANYTHING, BRANCH = range(4)
+
+    def __init__(self, paths):
+        self.states = []
+        self.kinds = {}
+        end = self.add_state(self.END, None, None)
+        self.start = self.compile_sequence(paths, end)
+
+    def add_state(self, kind, arg, next):
+        self.states.append((kind, arg, next))
+        return len(self.states) - 1
+
+    def compile_sequence(self, paths, next):
+        for path in reversed(paths):
+            next = self.compile_path(path, next)
+        return next
+
+    def compile_path(self, path, next):
+        if type(path) is tuple:
+            return self.compile_sequence(path, next)
+        elif type(path[0]) is bool:
+            readings = '|'.join(path[2]).split('|')
+            if readings == ['.+']:
+                state = self.add_state(self.ANYTHING, None, next)
+            else:
+                # Unknown kanjis are regex escaped
+                readings = [ re.sub(r'\\(.)', r'\1', r) for r in readings ]
+                state = self.add_state(self.CAPTURE, readings, next)
+            self.kinds[state] = path_kind(path)
+            return state
+        else:
+            branches = [ self.compile_path(p, next) for p in path ]
+            return self.add_state(self.BRANCH, branches, None)
+
+    def match(self, furi):
+        memo = {}
+        def solve(state, pos):
+            key = (state, pos)
+            if key in memo:
+                return memo[key]
+            kind, arg, next = self.states[state]
+            result = None
+            if kind == self.END:
+                if pos == len(furi):
+                    result = ()
+            elif kind == self.BRANCH:
+                for branch in arg:
+                    result = solve(branch, pos)
+                    if result is not None:
+                        break
+            elif kind == self.CAPTURE:
+                for reading in arg:
+                    if furi.startswith(reading, pos):
+                        rest = solve(next, pos + len(reading))
+                        if rest is not None:
+                            result = (reading, state, rest)
+                            break
+            else:
+                # Greedy, like .+
+                for end in range(len(furi), pos, -1):
+                    rest = solve(next, end)
+                    if rest is not None:
+                        result = (furi[pos:end], state, rest)
+                        break
+            memo[key] = result
+            return result
+
+        result = solve(self.start, 0)
+        if result is None:
+            return None
+        groups = []
+        kinds = []
+        while result:
+            groups.append(result[0])
+            kinds.append(self.kinds[result[1]])
+            result = result[2]
+        return Alignment(groups, kinds)
+
+class JukujikunMatcher():
+    # Aho-Corasick automaton finding all the jukujikuns of a surface in one
+    # pass. The jukujikuns are given by decreasing priority.
+    def __init__(self, jukujikuns):
+        self.jukujikuns = jukujikuns
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for priority, jukujikun in enumerate(jukujikuns):
+            state = 0
+            for char in jukujikun:
+                try:
+                    state = self.goto[state][char]
+                except KeyError:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                    state = len(self.goto) - 1
+            self.output[state].append(priority)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next in self.goto[state].items():
+                queue.append(next)
+                fail = self.fail[state]
+                while fail and not char in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next] = self.goto[fail].get(char, 0)
+                self.output[next] = self.output[next] + self.output[self.fail[next]]
+
+    def find(self, text):
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and not char in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for priority in self.output[state]:
+                yield end - len(self.jukujikuns[priority]), priority
+
+    def replacements(self, text):
+        # Jukujikuns are replaced one after the other, by priority then
+        # from left to right, skipping the ones overlapping a previous
+        # replacement. Returns their positions once the previous
+        # replacements are collapsed into a single item.
+        matches = sorted((priority, start) for start, priority in self.find(text))
+        taken = [False] * len(text)
+        done = []
+        for priority, start in matches:
+            length = len(self.jukujikuns[priority])
+            if any(taken[start:start+length]):
+                continue
+            taken[start:start+length] = [True] * length
+            shift = sum(l - 1 for s, l in done if s < start)
+            done.append((start, length))
+            yield start - shift, self.jukujikuns[priority]
 
 class Warifuri():
     test_readings = False
+    # 'regex' or 'dp', see PathAligner
+    aligner = 'regex'
+    # When profiling, row_profile holds measures about the last row
+    profile = False
+    # In seconds, per row
+    timeout = None
+    regex_cache_size = 10000
+    # To be increased whenever the way readings are derived changes
+    snapshot_version = 1
+    # Python re compatible form of (?!ヶ)(?P<rest>[\p{Hiragana}\p{Katakana}ー]+)|(?P<kanji>.)
+    # Generated using http://www.unicode.org/Public/UCD/latest/ucd/Scripts.txt
+    segment_regex = re.compile(r'(?!ヶ)(?P<rest>[\u3041-\u3096\u309D-\u309E\u309F\u30A1-\u30FA\u30FD-\u30FE\u30FF\u31F0-\u31FF\u30FC]+)|(?P<kanji>.)')
 
     def __init__(self):
         kata = "ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペホボポマミムメモャヤュユョヨラリルレロヮワヰヱヲン"
@@ -32,7 +211,12 @@ class Warifuri():
         ]
         self.readings = {}
         self.jukujikuns = {}
-        self.jukujikuns_list = []
+        self.jukujikun_matcher = None
+        # Compiled regexes by surface, and regex fragments by kanji
+        self.regex_cache = OrderedDict()
+        self.kanji_regex_cache = {}
+        self.regex_cache_hits = 0
+        self.regex_cache_misses = 0
 
     def kata_to_hira(self, string):
         return string.translate(self.kata_to_hira_map)
@@ -109,18 +293,28 @@ class Warifuri():
             previous = self.jukujikuns[kanjis]
         except KeyError:
             previous = []
-            pos = 0
-            for jukujikun in self.jukujikuns_list:
-                if len(jukujikun) < len(kanjis):
-                    break
-                pos = pos + 1
-            self.jukujikuns_list.insert(pos, kanjis)
         self.jukujikuns[kanjis] = previous + readings
+        self.jukujikun_matcher = None
+
+    def get_jukujikun_matcher(self):
+        if self.jukujikun_matcher is None:
+            # Longest first, then in the order they were added
+            jukujikuns = sorted(self.jukujikuns, key=len, reverse=True)
+            self.jukujikun_matcher = JukujikunMatcher(jukujikuns)
+        return self.jukujikun_matcher
+
+    def clear_regex_cache(self):
+        self.regex_cache.clear()
+        self.kanji_regex_cache.clear()
 
     def add_readings(self, kanjis, readings):
+        self.clear_regex_cache()
         if len(kanjis) == 1:
             readings = self.load_kanji_readings(kanjis, readings)
-            readings = list(set(readings))
+            # Deduplicated in a stable order: with a set, the order of
+            # the regex alternatives, hence ambiguous splits, would change
+            # from one run to another
+            readings = list(dict.fromkeys(readings))
             readings = readings + [self.hira_to_kata(r) for r in readings]
         else:
             self.add_jukujikun_readings(kanjis, readings)
@@ -133,16 +327,24 @@ class Warifuri():
             self.readings[code] = previous + readings
 
     def load_kanjidic_readings(self, filename):
-        all_readings = {}
-        root = ET.parse(filename).getroot()
-        for character in root.findall('character'):
-            char = character.find('literal').text
-            readings = [ nanori.text for nanori in character.iter('nanori') ]
-            for r in character.iter('reading'):
-                if r.get('r_type') in ['ja_on', 'ja_kun']:
-                    readings.append(r.text)
-            if char:
-                self.add_readings(char, readings)
+        if filename.endswith('.gz'):
+            f = gzip.open(filename)
+        else:
+            f = open(filename, 'rb')
+        with f:
+            # Characters are dropped once read, so that the whole document
+            # is never held in memory
+            for event, character in ET.iterparse(f):
+                if character.tag != 'character':
+                    continue
+                char = character.find('literal').text
+                readings = [ nanori.text for nanori in character.iter('nanori') ]
+                for r in character.iter('reading'):
+                    if r.get('r_type') in ['ja_on', 'ja_kun']:
+                        readings.append(r.text)
+                if char:
+                    self.add_readings(char, readings)
+                character.clear()
 
     def load_csv_readings(self, filename):
         with open(filename, newline='') as csvfile:
@@ -159,20 +361,67 @@ class Warifuri():
             except csv.Error as e:
                 sys.exit('file {}, line {}: {}'.format(filename, readings_reader.line_num, e))
 
+    def load_snapshot(self, filename, sources):
+        try:
+            with open(filename, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if (snapshot.get('version') != self.snapshot_version
+            or snapshot.get('sources') != sources):
+            return False
+        self.clear_regex_cache()
+        self.readings = snapshot['readings']
+        self.jukujikuns = snapshot['jukujikuns']
+        self.jukujikun_matcher = None
+        return True
+
+    def save_snapshot(self, filename, sources):
+        snapshot = {
+            'version': self.snapshot_version,
+            'sources': sources,
+            'readings': self.readings,
+            'jukujikuns': self.jukujikuns,
+        }
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
     def to_regex(self, paths):
         regex = []
         for path in paths:
             if type(path) is tuple:
                 block = ''.join(self.to_regex(path))
             elif type(path[0]) is bool:
-                readings = path[2]
-                block = '(' + '|'.join(readings) + ')'
+                if path[0]:
+                    block = self.kanji_regex(path[1], path[2])
+                else:
+                    block = '(' + '|'.join(path[2]) + ')'
             else:
                 parts = self.to_regex(path)
                 block = '(?:' + '|'.join(parts) + ')'
             regex.append(block)
         return regex
 
+    def group_kinds(self, paths):
+        # Kinds of the groups of the regex made by to_regex, in order
+        kinds = []
+        for path in paths:
+            if type(path) is tuple or type(path[0]) is not bool:
+                kinds.extend(self.group_kinds(path))
+            else:
+                kinds.append(path_kind(path))
+        return kinds
+
+    def kanji_regex(self, kanji, readings):
+        try:
+            return self.kanji_regex_cache[kanji]
+        except KeyError:
+            block = '(' + '|'.join(readings) + ')'
+            self.kanji_regex_cache[kanji] = block
+            return block
+
     def anything_path(self, kanjis):
         anything = [[ False, '', ['.+'] ]]
         anything = anything + [[ False, '', [''] ]] * (len(kanjis)-1)
@@ -198,35 +447,24 @@ class Warifuri():
         if type(paths) is tuple:
             paths = list(paths)
             kanjis = ''.join([ p[1] for p in paths ])
-            for jukujikun in self.jukujikuns_list:
+            for pos, jukujikun in self.get_jukujikun_matcher().replacements(kanjis):
                 readings = self.jukujikuns[jukujikun]
-                pos = 0
-                while True:
-                    try:
-                        pos = kanjis.index(jukujikun, pos)
-                    except ValueError:
-                        break
-                    j_paths = []
-                    for reading in readings:
-                        j_path = [ [False, '', r] for r in reading ]
-                        j_paths.append(tuple(j_path))
-                    replacement = [ j_paths + [tuple(paths[pos:pos+len(jukujikun)])] ]
-                    paths[pos:pos+len(jukujikun)] = [replacement]
-                    kanjis = kanjis[:pos] + ' ' + kanjis[pos+len(jukujikun):]
-                    pos = pos + 1
+                j_paths = []
+                for reading in readings:
+                    j_path = [ [False, '', r] for r in reading ]
+                    j_paths.append(tuple(j_path))
+                replacement = [ j_paths + [tuple(paths[pos:pos+len(jukujikun)])] ]
+                paths[pos:pos+len(jukujikun)] = [replacement]
             return tuple(paths)
         elif type(paths) is list and type(paths[0]) is not bool:
             for i, path in enumerate(paths):
                 paths[i] = self.add_jukujikun_paths(path)
         return paths
 
-    def split_furi(self, kanjis, furi):
+    def build_paths(self, kanjis):
         paths = []
-        # Python re compatible form of (?!ヶ)(?P<rest>[\p{Hiragana}\p{Katakana}ー]+)|(?P<kanji>.)
-        # Generated using http://www.unicode.org/Public/UCD/latest/ucd/Scripts.txt
-        regex = r'(?!ヶ)(?P<rest>[\u3041-\u3096\u309D-\u309E\u309F\u30A1-\u30FA\u30FD-\u30FE\u30FF\u31F0-\u31FF\u30FC]+)|(?P<kanji>.)'
         segments = []
-        for match in re.finditer(regex, kanjis):
+        for match in self.segment_regex.finditer(kanjis):
             segments.append(match.group(0))
             token = match.groupdict()
             if token['kanji']:
@@ -245,8 +483,62 @@ class Warifuri():
         else:
             paths = self.add_optimistic_paths(paths)
         paths = self.add_jukujikun_paths(paths)
-        regex = self.to_regex(paths)
-        match = re.match(''.join(regex) + '$', furi)
+        return segments, paths
+
+    def get_matcher(self, kanjis):
+        # The matcher only depends on the surface, and many dictionary rows
+        # share the same one
+        key = (kanjis, self.test_readings, self.aligner, self.profile)
+        try:
+            segments, matcher, kinds = self.regex_cache.pop(key)
+            self.regex_cache_hits = self.regex_cache_hits + 1
+        except KeyError:
+            self.regex_cache_misses = self.regex_cache_misses + 1
+            if self.profile:
+                start = time.perf_counter()
+            segments, paths = self.build_paths(kanjis)
+            if self.profile:
+                built = time.perf_counter()
+            kinds = None
+            if self.aligner == 'dp':
+                matcher = PathAligner(paths)
+            else:
+                matcher = re.compile(''.join(self.to_regex(paths)) + '$')
+                if self.profile:
+                    kinds = self.group_kinds(paths)
+            if self.profile:
+                self.row_profile['cached'] = False
+                self.row_profile['paths_ms'] = (built - start) * 1000
+                self.row_profile['compile_ms'] = (time.perf_counter() - built) * 1000
+            if len(self.regex_cache) >= self.regex_cache_size:
+                self.regex_cache.popitem(last=False)
+        self.regex_cache[key] = (segments, matcher, kinds)
+        return list(segments), matcher, kinds
+
+    def profile_match(self, matcher, match, kinds):
+        if self.aligner == 'dp':
+            self.row_profile['size'] = len(matcher.states)
+            if match:
+                kinds = match.kinds
+        else:
+            self.row_profile['size'] = len(matcher.pattern)
+            if match:
+                kinds = [ kinds[i] for i, group in enumerate(match.groups())
+                          if group is not None ]
+        if match:
+            self.row_profile['optimistic'] = 'optimistic' in kinds
+            self.row_profile['jukujikun'] = 'jukujikun' in kinds
+        else:
+            self.row_profile['failure'] = 'no match'
+
+    def split_furi(self, kanjis, furi):
+        segments, matcher, kinds = self.get_matcher(kanjis)
+        if self.profile:
+            start = time.perf_counter()
+        match = matcher.match(furi)
+        if self.profile:
+            self.row_profile['match_ms'] = (time.perf_counter() - start) * 1000
+            self.profile_match(matcher, match, kinds)
         if match:
             groups = list(match.groups())
         else:
@@ -264,6 +556,8 @@ class Warifuri():
         if (len(groups) == len(segments)):
             return (segments, groups)
         else:
+            if self.profile and match:
+                self.row_profile['failure'] = 'mismatch'
             raise ValueError('Unable to split furigana')
 
     def parse_csv_row(self, row):
@@ -271,10 +565,25 @@ class Warifuri():
         reading_pos = 11
         kanji = row[kanji_pos]
         reading = row[reading_pos].replace('.', '')
+        if self.profile:
+            self.row_profile = {
+                'surface': kanji, 'reading': reading, 'cached': True,
+                'paths_ms': 0.0, 'compile_ms': 0.0, 'match_ms': 0.0, 'size': 0,
+                'optimistic': False, 'jukujikun': False, 'failure': None,
+            }
         try:
-            kanji, reading = self.split_furi(kanji, reading)
-        except ValueError:
-            if warifuri.test_readings:
+            # A runaway match is interrupted by SIGALRM, see raise_timeout
+            if self.timeout:
+                signal.setitimer(signal.ITIMER_REAL, self.timeout)
+            try:
+                kanji, reading = self.split_furi(kanji, reading)
+            finally:
+                if self.timeout:
+                    signal.setitimer(signal.ITIMER_REAL, 0)
+        except ValueError as e:
+            if self.profile and isinstance(e, SplitTimeout):
+                self.row_profile['failure'] = 'timeout'
+            if self.test_readings:
                 return None
             kanji, reading = [kanji], [reading]
 
@@ -283,57 +592,426 @@ class Warifuri():
         row[reading_pos] = ''.join(reading)
         return row
 
-def worker_main(warifuri, queue, lock, output_csv, error_csv):
-    while True:
-        item = queue.get(True)
-        if item == None:
-            queue.put(None)
-            break
+def hash_files(filenames):
+    hashes = []
+    for filename in filenames:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        hashes.append(sha1.hexdigest())
+    return hashes
+
+class Manifest():
+    # Records the input and output of every processed row, along with the
+    # readings they were processed with. Rows whose surface contains no
+    # kanji or jukujikun whose readings changed since are reused as is.
+    version = 1
+
+    def __init__(self, filename, warifuri):
+        self.filename = filename
+        self.tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        # None means everything has to be processed again
+        self.changed_kanjis = None
+        self.changed_jukujikuns = None
+        state = self.get_state(warifuri)
+        self.old = None
+        if os.path.exists(filename):
+            self.old = sqlite3.connect(filename)
+            try:
+                row = self.old.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()
+                previous = pickle.loads(row[0])
+            except (sqlite3.Error, TypeError, pickle.UnpicklingError):
+                previous = None
+            if previous and previous['config'] == state['config']:
+                self.changed_kanjis = self.changed_keys(previous['readings'], state['readings'])
+                self.changed_kanjis = set(chr(code) for code in self.changed_kanjis)
+                self.changed_jukujikuns = self.changed_keys(previous['jukujikuns'], state['jukujikuns'])
+
+        self.new = sqlite3.connect(self.tmp)
+        self.new.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value BLOB)')
+        self.new.execute('CREATE TABLE rows (file TEXT, line INTEGER, input TEXT, '
+                         'output TEXT, ok INTEGER, PRIMARY KEY (file, line))')
+        self.new.execute("INSERT INTO meta VALUES ('state', ?)",
+                         (pickle.dumps(state, pickle.HIGHEST_PROTOCOL),))
+        self.pending = []
+
+    def get_state(self, warifuri):
+        # Among jukujikuns of the same length, the first added ones are
+        # tried first
+        jukujikuns = {}
+        ranks = {}
+        for jukujikun, readings in warifuri.jukujikuns.items():
+            rank = ranks.get(len(jukujikun), 0)
+            ranks[len(jukujikun)] = rank + 1
+            jukujikuns[jukujikun] = (rank, readings)
+        return {
+            'config': (self.version, warifuri.snapshot_version,
+                       warifuri.test_readings, warifuri.aligner),
+            'readings': warifuri.readings,
+            'jukujikuns': jukujikuns,
+        }
+
+    def changed_keys(self, old, new):
+        changed = set(key for key in old if old[key] != new.get(key))
+        return changed | set(key for key in new if not key in old)
+
+    def is_affected(self, surface):
+        if self.changed_kanjis is None:
+            return True
+        if not self.changed_kanjis.isdisjoint(surface):
+            return True
+        for jukujikun in self.changed_jukujikuns:
+            if jukujikun in surface:
+                return True
+        return False
+
+    def previous_rows(self, key):
+        if self.old is None or self.changed_kanjis is None:
+            return
+        for line, input, output, ok in self.old.execute(
+                'SELECT line, input, output, ok FROM rows WHERE file = ? ORDER BY line', (key,)):
+            yield line, input, output, bool(ok)
+
+    def lookup(self, key, rows):
+        # Yields the (line, row, input, result) of the rows, the result
+        # being None unless the previous one can be reused. Files that
+        # were processed in place give back the previous output, in which
+        # case the original row is used instead.
+        previous = self.previous_rows(key)
+        last = (-1, None, None, None)
+        for line, row in enumerate(rows):
+            input = json.dumps(row, ensure_ascii=False)
+            while last[0] < line:
+                last = next(previous, (float('inf'), None, None, None))
+            result = None
+            if last[0] == line:
+                old_line, old_input, old_output, ok = last
+                if ok and input == old_output and input != old_input:
+                    row, input = json.loads(old_input), old_input
+                if input == old_input and not self.is_affected(row[0]):
+                    result = (ok, json.loads(old_output))
+            yield line, row, input, result
+
+    def add(self, key, line, input, ok, row):
+        self.pending.append((key, line, input, json.dumps(row, ensure_ascii=False), ok))
+        if len(self.pending) >= 1000:
+            self.new.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?)', self.pending)
+            self.pending = []
+
+    def close(self):
+        self.new.executemany('INSERT INTO rows VALUES (?, ?, ?, ?, ?)', self.pending)
+        self.new.commit()
+        self.new.close()
+        if self.old is not None:
+            self.old.close()
+        os.replace(self.tmp, self.filename)
+
+class Profile():
+    # Summary of the measures of Warifuri.row_profile over all rows
+    timings = ['total_ms', 'paths_ms', 'compile_ms', 'match_ms']
+    time_buckets = [0.01, 0.1, 1, 10, 100, 1000]
+    size_buckets = [100, 1000, 10000, 100000, 1000000]
+
+    def __init__(self, top=20):
+        self.top = top
+        self.rows = 0
+        self.cached = 0
+        self.used = {'optimistic': 0, 'jukujikun': 0}
+        self.failures = {}
+        self.histograms = {}
+        for name in self.timings:
+            self.histograms[name] = [0] * (len(self.time_buckets) + 1)
+        self.histograms['size'] = [0] * (len(self.size_buckets) + 1)
+        # Heap of the slowest rows so far
+        self.slowest = []
+
+    def observe(self, name, buckets, value):
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i = i + 1
+        self.histograms[name][i] = self.histograms[name][i] + 1
+
+    def add(self, record):
+        self.rows = self.rows + 1
+        if record['cached']:
+            self.cached = self.cached + 1
+        for used in self.used:
+            if record[used]:
+                self.used[used] = self.used[used] + 1
+        failure = record['failure']
+        if failure:
+            self.failures[failure] = self.failures.get(failure, 0) + 1
+        for name in self.timings:
+            self.observe(name, self.time_buckets, record[name])
+        if not record['cached']:
+            self.observe('size', self.size_buckets, record['size'])
+        entry = (record['total_ms'], self.rows, record)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def histogram(self, name, buckets):
+        labels = [ str(bucket) for bucket in buckets ] + ['+Inf']
+        return dict(zip(labels, self.histograms[name]))
+
+    def summary(self):
+        histograms = {}
+        for name in self.timings:
+            histograms[name] = self.histogram(name, self.time_buckets)
+        # Sizes are those of the regexes or aligners built, not reused
+        histograms['size'] = self.histogram('size', self.size_buckets)
+        slowest = [ entry[2] for entry in sorted(self.slowest, reverse=True) ]
+        return {
+            'rows': self.rows,
+            'cached': self.cached,
+            'used': self.used,
+            'failures': self.failures,
+            'histograms': histograms,
+            'slowest': slowest,
+        }
+
+worker_warifuri = None
+
+def init_worker(warifuri):
+    # With fork, the loaded reading tables are inherited rather than pickled
+    global worker_warifuri
+    worker_warifuri = warifuri
+    if warifuri.timeout:
+        signal.signal(signal.SIGALRM, raise_timeout)
+
+def parse_chunk(rows):
+    results = []
+    records = []
+    hits = worker_warifuri.regex_cache_hits
+    misses = worker_warifuri.regex_cache_misses
+    for row in rows:
+        if worker_warifuri.profile:
+            start = time.perf_counter()
+        parsed = worker_warifuri.parse_csv_row(row)
+        if worker_warifuri.profile:
+            worker_warifuri.row_profile['total_ms'] = (time.perf_counter() - start) * 1000
+            records.append(worker_warifuri.row_profile)
+        if parsed:
+            results.append((True, parsed))
         else:
-            row = warifuri.parse_csv_row(item)
-            lock.acquire()
-            if row:
-                output_csv.writerow(row)
+            results.append((False, row))
+    # Workers report their regex cache usage and profiles back
+    hits = worker_warifuri.regex_cache_hits - hits
+    misses = worker_warifuri.regex_cache_misses - misses
+    return results, (hits, misses, records)
+
+def read_chunks(reader, size):
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def map_chunks(warifuri, chunks, jobs):
+    # Yields the results of the (tag, rows) chunks in input order
+    if jobs <= 1:
+        init_worker(warifuri)
+        for tag, chunk in chunks:
+            yield tag, parse_chunk(chunk)
+        return
+
+    pool = Pool(jobs, init_worker, (warifuri,))
+    # Only a few chunks are in flight at a time
+    pending = deque()
+    for tag, chunk in chunks:
+        if len(pending) >= 2 * jobs:
+            done_tag, result = pending.popleft()
+            yield done_tag, result.get()
+        pending.append((tag, pool.apply_async(parse_chunk, (chunk,))))
+    while pending:
+        done_tag, result = pending.popleft()
+        yield done_tag, result.get()
+    pool.close()
+    pool.join()
+
+def write_results(results, output_csv, error_csv):
+    errors = 0
+    for ok, row in results:
+        if ok:
+            output_csv.writerow(row)
+        else:
+            error_csv.writerow(row)
+            errors = errors + 1
+    return errors
+
+def add_stats(stats, chunk_stats, profile):
+    hits, misses, records = chunk_stats
+    stats[0] = stats[0] + hits
+    stats[1] = stats[1] + misses
+    if profile is not None:
+        for record in records:
+            profile.add(record)
+
+def process_rows(warifuri, reader, output_csv, error_csv, jobs, chunk_size=1000,
+                 profile=None):
+    stats = [0, 0]
+    chunks = ((None, chunk) for chunk in read_chunks(reader, chunk_size))
+    for tag, (results, chunk_stats) in map_chunks(warifuri, chunks, jobs):
+        add_stats(stats, chunk_stats, profile)
+        write_results(results, output_csv, error_csv)
+    return stats
+
+def read_files_chunks(filenames, encoding, size, manifest=None):
+    # Each file ends with an empty chunk, so that even empty files are
+    # written and the end of each file is known. With a manifest, only
+    # the rows that can't be reused are sent to the workers, the tag
+    # holding all of them.
+    for filename in filenames:
+        key = os.path.basename(filename)
+        with open(filename, encoding=encoding, newline='') as f:
+            if manifest is None:
+                for chunk in read_chunks(csv.reader(f), size):
+                    yield (filename, False, None), chunk
+            else:
+                entries = manifest.lookup(key, csv.reader(f))
+                for chunk in read_chunks(entries, size):
+                    rows = [ row for line, row, input, result in chunk if result is None ]
+                    yield (filename, False, chunk), rows
+        yield (filename, True, []), []
+
+def process_files(warifuri, filenames, output_dir, encoding, error_csv, jobs,
+                  chunk_size=1000, progress=sys.stderr, manifest=None, profile=None):
+    stats = [0, 0]
+    output = None
+    start = time.time()
+    chunks = read_files_chunks(filenames, encoding, chunk_size, manifest)
+    for (filename, last, entries), (results, chunk_stats) in map_chunks(warifuri, chunks, jobs):
+        add_stats(stats, chunk_stats, profile)
+        if output is None:
+            # Written next to the destination, then renamed once complete
+            key = os.path.basename(filename)
+            destination = os.path.join(output_dir, key)
+            tmp = '{}.{}.tmp'.format(destination, os.getpid())
+            output = open(tmp, 'w', encoding=encoding, newline='')
+            output_csv = csv.writer(output, lineterminator='\n')
+            rows, errors, reused = 0, 0, 0
+        if entries is not None:
+            parsed = iter(results)
+            results = []
+            for line, row, input, result in entries:
+                if result is None:
+                    result = next(parsed)
+                else:
+                    reused = reused + 1
+                manifest.add(key, line, input, *result)
+                results.append(result)
+        rows = rows + len(results)
+        errors = errors + write_results(results, output_csv, error_csv)
+        if last:
+            output.close()
+            os.replace(tmp, destination)
+            output = None
+            # Files are processed one after the other, although the chunks
+            # at the end of one overlap with the beginning of the next
+            seconds = time.time() - start
+            start = time.time()
+            if manifest is not None:
+                progress.write('{}: {} rows ({} reused), '.format(filename, rows, reused))
             else:
-                error_csv.writerow(item)
-            lock.release()
+                progress.write('{}: {} rows, '.format(filename, rows))
+            progress.write('{} errors in {:0.3f}s ({:0.0f} rows/s)\n'.format(
+                errors, seconds, rows / seconds if seconds > 0 else 0))
+            progress.flush()
+    if manifest is not None:
+        manifest.close()
+    return stats
 
 if __name__ == '__main__':
-    import getopt, time
+    import getopt
 
-    opts, args = getopt.getopt(sys.argv[1:], 'tr', ['--time', '--test-readings'])
+    opts, args = getopt.getopt(sys.argv[1:], 'trj:a:s:o:e:m:p:T:', ['time', 'test-readings', 'jobs=', 'aligner=', 'snapshot=', 'output-dir=', 'encoding=', 'manifest=', 'profile=', 'timeout='])
 
     if len(args) == 0:
-        print('Usage: {} [-r|--test-readings] kanjidic2.xml [other_readings.csv] < dict.csv > dict.furi.splitted.csv'.format(sys.argv[0]))
+        print('Usage: {} [-r|--test-readings] [-j|--jobs N] [-a|--aligner regex|dp] [-s|--snapshot FILE] [-p|--profile FILE] [-T|--timeout SECONDS] kanjidic2.xml[.gz] [other_readings.csv] < dict.csv > dict.furi.splitted.csv'.format(sys.argv[0]))
+        print('       {} [options] [-e|--encoding ENCODING] [-m|--manifest FILE] -o|--output-dir DIR kanjidic2.xml[.gz] other_readings.csv dict.csv...'.format(sys.argv[0]))
         sys.exit(1)
 
     warifuri = Warifuri()
     timeit = False
+    jobs = cpu_count()
+    snapshot = None
+    output_dir = None
+    encoding = None
+    manifest = None
+    profile = None
     for opt, optarg in opts:
         if opt in ['-r', '--test-readings']:
             warifuri.test_readings = True
         elif opt in ['-t', '--time']:
             timeit = True
+        elif opt in ['-j', '--jobs']:
+            jobs = int(optarg)
+        elif opt in ['-a', '--aligner']:
+            if not optarg in ['regex', 'dp']:
+                sys.exit('Unknown aligner {}, expected regex or dp'.format(optarg))
+            warifuri.aligner = optarg
+        elif opt in ['-s', '--snapshot']:
+            snapshot = optarg
+        elif opt in ['-o', '--output-dir']:
+            output_dir = optarg
+        elif opt in ['-e', '--encoding']:
+            encoding = optarg
+        elif opt in ['-m', '--manifest']:
+            manifest = optarg
+        elif opt in ['-p', '--profile']:
+            profile = optarg
+            warifuri.profile = True
+        elif opt in ['-T', '--timeout']:
+            warifuri.timeout = float(optarg)
+    if output_dir and len(args) < 3:
+        sys.exit('No dictionary files given for {}'.format(output_dir))
+    if manifest and not output_dir:
+        sys.exit('A manifest can only be used with --output-dir')
 
-    warifuri.load_kanjidic_readings(args[0])
-    if len(args) > 1:
-        warifuri.load_csv_readings(args[1])
+    if timeit:
+        load_start = time.time()
+    if snapshot:
+        sources = hash_files(args[:2])
+    if not snapshot or not warifuri.load_snapshot(snapshot, sources):
+        warifuri.load_kanjidic_readings(args[0])
+        if len(args) > 1:
+            warifuri.load_csv_readings(args[1])
+        if snapshot:
+            warifuri.save_snapshot(snapshot, sources)
+    if timeit:
+        sys.stderr.write('Loaded readings in %0.3fs\n' % (time.time()-load_start))
 
     mecabdict = csv.writer(sys.stdout, lineterminator='\n')
     mecabdicterror = csv.writer(sys.stderr, lineterminator='\n')
     if timeit:
         time_start = time.time()
 
-    queue = Queue(maxsize=5)
-    lock = Lock()
-    pool = Pool(initializer=worker_main,
-                initargs=(warifuri, queue, lock, mecabdict, mecabdicterror))
-
-    for line in csv.reader(iter(sys.stdin.readline, '')):
-        queue.put(line)
-    queue.put(None)
-    pool.close()
-    pool.join()
+    row_profile = Profile() if profile else None
+    if output_dir:
+        if manifest:
+            manifest = Manifest(manifest, warifuri)
+        hits, misses = process_files(warifuri, args[2:], output_dir, encoding,
+                                     mecabdicterror, jobs, manifest=manifest,
+                                     profile=row_profile)
+    else:
+        reader = csv.reader(iter(sys.stdin.readline, ''))
+        hits, misses = process_rows(warifuri, reader, mecabdict, mecabdicterror, jobs,
+                                    profile=row_profile)
+    if profile:
+        summary = json.dumps(row_profile.summary(), ensure_ascii=False, indent=2)
+        if profile == '-':
+            sys.stderr.write(summary + '\n')
+        else:
+            with open(profile, 'w') as f:
+                f.write(summary + '\n')
     if timeit:
         time_end = time.time()
         sys.stderr.write('Took %0.3fs\n' % (time_end-time_start))
+        if hits + misses > 0:
+            sys.stderr.write('Regex cache: %d hits, %d misses (%0.1f%% hit rate)\n'
+                             % (hits, misses, 100.0 * hits / (hits + misses)))